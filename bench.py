@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""
+bench.py - Benchmarks of the nailcast pipeline
+
+Usage: python bench.py [results.json [baseline.json]]
+
+Times the halftone conversion, the nail layout, the mesh generation, the
+STL/POV writer and the SVG path of nailcast.py on fixed inputs: two
+synthetic images (a color gradient and seeded noise), dot.png and
+Lenna.png.  Every benchmark runs in a child process of its own so its
+peak memory can be read back.  Results are written as JSON (default
+/tmp/bench.json); given a baseline from an earlier run, the time ratios
+are printed next to each result.
+
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import resource
+import multiprocessing
+import Numeric
+import Image
+import nailcast
+import nailcast2
+from halftone import get_halftones, HalftoneLUT
+from euclid import Vector3, FastVector3, madd
+from stl import STL, STLFacet
+
+INPUTS = ("gradient", "noise", "dot.png", "Lenna.png")
+SYNTHETIC_SIZE = 512 # pixels, width and height of the synthetic inputs
+STL_FACETS = 100000 # random facets for the STL writer benchmarks
+CYLINDERS = 5000 # cylinders for the vector benchmarks
+results_json = "/tmp/bench.json"
+scratch = "/tmp/bench" # benchmarks write their files to <scratch>.*
+min_seconds = 1.0 # repeat quicker benchmarks (up to max_repeats) and keep the best
+max_repeats = 5
+
+# The input image called name, flipped like nailcast2.main() does
+def Input(name):
+    n = SYNTHETIC_SIZE
+    if name == "gradient":
+        x = Numeric.resize(Numeric.arange(n), (n, n))
+        rgb = Numeric.zeros((n, n, 3), Numeric.UnsignedInt8)
+        rgb[:, :, 0] = (x * 256 / n).astype(Numeric.UnsignedInt8)
+        rgb[:, :, 1] = (Numeric.transpose(x) * 256 / n).astype(Numeric.UnsignedInt8)
+        rgb[:, :, 2] = 128
+        return Image.fromstring("RGB", (n, n), rgb.tostring())
+    if name == "noise":
+        rand = random.Random(1)
+        data = "".join([chr(rand.randrange(256)) for i in xrange(n * n * 3)])
+        return Image.fromstring("RGB", (n, n), data)
+    return Image.open(name).transpose(Image.FLIP_TOP_BOTTOM)
+
+def Lut():
+    if nailcast2.lut_bits:
+        return HalftoneLUT(nailcast2.lut_bits)
+    return None
+
+# A mesh with the nails of the image, as nailcast2.main() lays them
+def NailMesh(im):
+    mesh = nailcast2.MeshGenerator(nailcast2.triangle_side_mm, nailcast2.margin_mm)
+    lut = Lut()
+    for offset in nailcast2.LatticeOffsets(nailcast2.triangle_side_mm):
+        nailcast2.artwork2(im, mesh, offset, lut)
+    return mesh
+
+def FileBytes(*names):
+    return sum([os.path.getsize(name) for name in names if os.path.exists(name)])
+
+# Every benchmark takes the input image and returns (seconds, items,
+# bytes written); the unit of items is listed in BENCHMARKS.
+
+def BenchGetHalftone(im):
+    centers = nailcast2.artwork_centers(im, (0, 0)).tolist()
+    start = time.time()
+    for x, y in centers:
+        nailcast2.get_halftone((x, y), im)
+    return time.time() - start, len(centers), 0
+
+def BenchGetHalftones(im):
+    centers = nailcast2.artwork_centers(im, (0, 0))
+    lut = Lut()
+    start = time.time()
+    get_halftones(centers, im, nailcast2.canvas_width_mm, lut)
+    return time.time() - start, len(centers), 0
+
+def BenchArtwork2(im):
+    start = time.time()
+    mesh = NailMesh(im)
+    return time.time() - start, len(mesh.nails), 0
+
+def BenchGetExtent(im):
+    mesh = NailMesh(im)
+    start = time.time()
+    mesh.GetExtent()
+    return time.time() - start, len(mesh.nails), 0
+
+def BenchCreateNailHash(im):
+    mesh = NailMesh(im)
+    mesh.GetExtent()
+    start = time.time()
+    mesh.CreateNailHash()
+    return time.time() - start, len(mesh.nails), 0
+
+def RenderWith(im, render):
+    mesh = NailMesh(im)
+    stl = STL(scratch + ".stl", scratch + ".pov", "Bench", nailcast2.pov_mesh2)
+    start = time.time()
+    render(mesh, stl)
+    stl.Close()
+    return time.time() - start, stl.nfaces, FileBytes(scratch + ".stl", scratch + ".pov")
+
+def BenchRender(im):
+    return RenderWith(im, lambda mesh, stl: mesh.Render(stl))
+
+def BenchRenderBatched(im):
+    return RenderWith(im, lambda mesh, stl: mesh.RenderBatched(stl))
+
+# Seeded random facets, most of them valid
+def RandomFacets(n):
+    rand = random.Random(1)
+    def point():
+        return Vector3(rand.uniform(0, 280), rand.uniform(0, 280), rand.uniform(-6, 3))
+    return [STLFacet(point(), point(), point()) for i in xrange(n)]
+
+def BenchAddFacet(im):
+    facets = RandomFacets(STL_FACETS)
+    stl = STL(scratch + ".stl", scratch + ".pov", "Bench", nailcast2.pov_mesh2)
+    start = time.time()
+    for k in xrange(len(facets)):
+        stl.AddFacet(facets[k], k % 2)
+    seconds = time.time() - start
+    stl.Close()
+    return seconds, stl.nfaces, 50 * stl.nfaces
+
+def BenchClose(im):
+    facets = RandomFacets(STL_FACETS)
+    stl = STL(scratch + ".stl", scratch + ".pov", "Bench", nailcast2.pov_mesh2)
+    for k in xrange(len(facets)):
+        stl.AddFacet(facets[k], k % 2)
+    start = time.time()
+    stl.Close()
+    return time.time() - start, stl.nfaces, FileBytes(scratch + ".stl", scratch + ".pov")
+
+# The vector math of MeshGenerator.AddTriangle() over a whole board, as
+# it was before AddTriangle() moved to tuples, with vectors of class
+# `vector`.  top(b, length, light) makes a nail tip.
+def TriangleWorkload(vector, top, mesh, stl):
+    lights = [vector(*nailcast2.LightDirection(d)) for d in range(3)]
+    for i in range(mesh.ny):
+        dj = (i % 2) * 0.5
+        for j in range(mesh.nx + 1):
+            x = j + 0.5 - dj
+            base = [vector(*mesh.Coords(x, i, 0)),
+                    vector(*mesh.Coords(x - 0.5, i + 1, 0)),
+                    vector(*mesh.Coords(x + 0.5, i + 1, 0))]
+            nail = mesh.FindNail(x, i)
+            if nail >= 0:
+                length = nailcast2.triangle_side_mm * 5.0 / 6.0 * float(mesh.nails.length[nail])
+                light = lights[mesh.nails.direction[nail]]
+                tops = [top(b, length, light) for b in base]
+                stl.AddFacet(STLFacet(tops[0], tops[1], tops[2]), 0)
+                for k in range(3):
+                    k1 = (k + 1) % 3
+                    stl.AddFacet(STLFacet(base[k], base[k1], tops[k1]), 0)
+                    stl.AddFacet(STLFacet(base[k], tops[k1], tops[k]), 0)
+            else:
+                stl.AddFacet(STLFacet(base[0], base[1], base[2]), 1)
+    return stl.nfaces
+
+# The vector math of STL.AddCylinder() for a row of cylinders
+def CylinderWorkload(vector, stl, count, prec=12, radius=1.0, height=5.0):
+    for k in range(count):
+        bottom = vector(k * 0.01, k * 0.02, 0.0)
+        top = vector(k * 0.01, k * 0.02, height)
+        dangle = 2 * math.pi / prec
+        for i in range(prec):
+            a0 = i * dangle
+            a1 = a0 + dangle
+            r0 = radius * vector(math.cos(a0), math.sin(a0), 0)
+            r1 = radius * vector(math.cos(a1), math.sin(a1), 0)
+            stl.AddFacet(STLFacet(bottom + r0, bottom + r1, top + r1), 1)
+            stl.AddFacet(STLFacet(top + r1, top + r0, bottom + r0), 1)
+            stl.AddFacet(STLFacet(top, top + r0, top + r1), 1)
+    return stl.nfaces
+
+def PlainTop(b, length, light):
+    return b + length * light
+
+def FusedTop(b, length, light):
+    return madd(b.copy(), length, light)
+
+def VectorTriangles(vector, top):
+    def bench(im):
+        mesh = NailMesh(Input("gradient"))
+        mesh.PrepareRender()
+        stl = STL(scratch + ".stl", None, "Bench")
+        start = time.time()
+        facets = TriangleWorkload(vector, top, mesh, stl)
+        seconds = time.time() - start
+        stl.Close()
+        return seconds, facets, 0
+    return bench
+
+def VectorCylinders(vector):
+    def bench(im):
+        stl = STL(scratch + ".stl", None, "Bench")
+        start = time.time()
+        facets = CylinderWorkload(vector, stl, CYLINDERS)
+        seconds = time.time() - start
+        stl.Close()
+        return seconds, facets, 0
+    return bench
+
+# nailcast.portrait() without the display step
+def BenchSVG(im):
+    im = im.transpose(Image.FLIP_TOP_BOTTOM)
+    screen_pixels_per_mm = 92 / 25.4
+    canvas_pixels = 300 * screen_pixels_per_mm
+    s = 3.7 * screen_pixels_per_mm
+    r = int(round(math.sqrt(s * s - s * s / 4) / 2))
+    s = int(round(s))
+    start = time.time()
+    scale = canvas_pixels / im.size[1]
+    im = im.resize((int(scale * im.size[0]), int(scale * im.size[1])))
+    scene = nailcast.Scene(scratch, im.size[1], im.size[0])
+    makeitwork = math.tan(math.pi / 6) * 0.5 * s
+    scene.add(nailcast.Rectangle((0,0), im.size[1], im.size[0], (255,255,255)))
+    lut = None
+    if nailcast.lut_bits:
+        lut = HalftoneLUT(nailcast.lut_bits)
+    count = nailcast.artwork(scene, (0, r), s, r, im, lut)
+    count += nailcast.artwork(scene, (s / 2, r - makeitwork), s, r, im, lut)
+    scene.write_svg()
+    return time.time() - start, count, FileBytes(scratch + ".svg")
+
+# (name, function, unit of items, whether it depends on the input image)
+BENCHMARKS = [
+    ("get_halftone", BenchGetHalftone, "samples", True),
+    ("get_halftones", BenchGetHalftones, "samples", True),
+    ("artwork2", BenchArtwork2, "nails", True),
+    ("GetExtent", BenchGetExtent, "nails", True),
+    ("CreateNailHash", BenchCreateNailHash, "nails", True),
+    ("Render", BenchRender, "facets", True),
+    ("RenderBatched", BenchRenderBatched, "facets", True),
+    ("STL.AddFacet", BenchAddFacet, "facets", False),
+    ("STL.Close", BenchClose, "facets", False),
+    ("svg", BenchSVG, "nails", True),
+    ("Vector3 AddTriangle", VectorTriangles(Vector3, PlainTop), "facets", False),
+    ("FastVector3 AddTriangle", VectorTriangles(FastVector3, PlainTop), "facets", False),
+    ("FastVector3 madd", VectorTriangles(FastVector3, FusedTop), "facets", False),
+    ("Vector3 AddCylinder", VectorCylinders(Vector3), "facets", False),
+    ("FastVector3 AddCylinder", VectorCylinders(FastVector3), "facets", False),
+]
+
+# Run one benchmark in this (child) process and send back its result
+def RunOne(conn, name, function, input_name):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        im = input_name and Input(input_name)
+        best = None
+        total = 0
+        for k in range(max_repeats):
+            seconds, items, nbytes = function(im)
+            total = total + seconds
+            if best is None or seconds < best:
+                best = seconds
+            if total >= min_seconds:
+                break
+        seconds = best
+    finally:
+        sys.stdout = stdout
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send((seconds, items, nbytes, peak_kb))
+    conn.close()
+
+def Run(name, function, unit, input_name):
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=RunOne,
+                                      args=(child, name, function, input_name))
+    process.start()
+    child.close()
+    seconds, items, nbytes, peak_kb = parent.recv()
+    process.join()
+    seconds = max(seconds, 1e-9)
+    return {"benchmark": name, "input": input_name, "seconds": seconds,
+            "items": items, "unit": unit, "items_per_second": items / seconds,
+            "mb_per_second": nbytes / seconds / 1e6, "peak_mb": peak_kb / 1024.0}
+
+def Report(result, baseline=None):
+    line = "%-24s %-10s %8.3fs %12.0f %s/s %7.1f MB/s %7.1f MB peak" % (
+        result["benchmark"], result["input"] or "-", result["seconds"],
+        result["items_per_second"], result["unit"], result["mb_per_second"],
+        result["peak_mb"])
+    if baseline:
+        for old in baseline["results"]:
+            if (old["benchmark"], old["input"]) == (result["benchmark"], result["input"]):
+                line = line + "  x%.2f" % (old["seconds"] / result["seconds"])
+    print line
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    fname = results_json
+    if len(argv) > 1:
+        fname = argv[1]
+    baseline = None
+    if len(argv) > 2:
+        baseline = json.load(open(argv[2]))
+
+    results = []
+    for name, function, unit, per_input in BENCHMARKS:
+        for input_name in per_input and INPUTS or (None,):
+            result = Run(name, function, unit, input_name)
+            Report(result, baseline)
+            results.append(result)
+
+    f = open(fname, "w")
+    json.dump({"time": time.time(), "python": sys.version.split()[0],
+               "results": results}, f, indent=1)
+    f.close()
+    print "results in %s" % fname
+
+if __name__ == '__main__': main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+cache.py - Content addressed cache of intermediate results
+
+Entries are plain strings stored in files named after the SHA-1 of
+everything that went into computing them, so a changed input simply
+misses and old entries are never wrong.  Trim() keeps the directory
+under a size limit by deleting the least recently used entries.
+
+"""
+
+import os
+import shutil
+import hashlib
+
+class TileCache:
+    # max_bytes - size Trim() cuts the directory down to, None for no limit
+    def __init__(self, dirname, max_bytes=None):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    # Key for a list of parts: strings are hashed as is, anything else
+    # through repr(), so callers pass array.tostring() for arrays.
+    def Key(self, *parts):
+        h = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, str):
+                part = repr(part)
+            h.update("%d:" % len(part))
+            h.update(part)
+        return h.hexdigest()
+
+    def Path(self, key):
+        return os.path.join(self.dirname, key[:2], key[2:])
+
+    def Get(self, key):
+        path = self.Path(key)
+        if not os.path.exists(path):
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        self.Touch(path)
+        f = open(path, "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def Put(self, key, data):
+        tmpname = self.TempName(key)
+        f = open(tmpname, "wb")
+        f.write(data)
+        f.close()
+        os.rename(tmpname, self.Path(key))
+
+    # Write under a temporary name so readers never see half an entry
+    def TempName(self, key):
+        path = self.Path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return "%s.%d" % (path, os.getpid())
+
+    # Like Get() and Put(), for entries too big to hold in memory: the
+    # entry is copied to / from the file fname.  GetFile() returns
+    # whether it found the entry.
+    def GetFile(self, key, fname):
+        path = self.Path(key)
+        if not os.path.exists(path):
+            self.misses = self.misses + 1
+            return False
+        self.hits = self.hits + 1
+        self.Touch(path)
+        shutil.copyfile(path, fname)
+        return True
+
+    def PutFile(self, key, fname):
+        tmpname = self.TempName(key)
+        shutil.copyfile(fname, tmpname)
+        os.rename(tmpname, self.Path(key))
+
+    # Mark an entry as used, for Trim()
+    def Touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    # Delete the least recently used entries until the directory holds
+    # no more than max_bytes.  Returns the number of entries deleted.
+    def Trim(self):
+        if self.max_bytes is None:
+            return 0
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.dirname):
+            for name in filenames:
+                # Skip entries still being written (TempName)
+                if "." in name:
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total = total + st.st_size
+        entries.sort()
+        deleted = 0
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total = total - size
+            deleted = deleted + 1
+        return deleted
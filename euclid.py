@@ -33,6 +33,11 @@ import math
 import operator
 import types
 
+try:
+    import Numeric
+except ImportError:
+    Numeric = None  # Vector3Array needs Numeric
+
 # Some magic here.  If _use_slots is True, the classes will derive from
 # object and will define a __slots__ class variable.  If _use_slots is
 # False, classes will be old-style and will not define __slots__.
@@ -530,6 +535,245 @@ class Vector3:
                        self.y - d * normal.y,
                        self.z - d * normal.z)
 
+# Vector3 for hot loops.  The operators assume the other operand has x, y
+# and z (a FastVector3 or Vector3) or is a number, so there is no
+# isinstance dispatch, no Point3 promotion and no swizzling; reading a
+# missing attribute is a plain AttributeError.  Results are FastVector3.
+class FastVector3:
+    __slots__ = ['x', 'y', 'z']
+
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+    def __copy__(self):
+        return FastVector3(self.x, self.y, self.z)
+
+    copy = __copy__
+
+    def __repr__(self):
+        return 'FastVector3(%.2f, %.2f, %.2f)' % (self.x,
+                                                  self.y,
+                                                  self.z)
+
+    def __len__(self):
+        return 3
+
+    def __getitem__(self, key):
+        return (self.x, self.y, self.z)[key]
+
+    def __iter__(self):
+        return iter((self.x, self.y, self.z))
+
+    def __eq__(self, other):
+        return self.x == other.x and \
+               self.y == other.y and \
+               self.z == other.z
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __add__(self, other):
+        return FastVector3(self.x + other.x,
+                           self.y + other.y,
+                           self.z + other.z)
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return FastVector3(self.x - other.x,
+                           self.y - other.y,
+                           self.z - other.z)
+
+    def __rsub__(self, other):
+        return FastVector3(other.x - self.x,
+                           other.y - self.y,
+                           other.z - self.z)
+
+    # Scalars only
+    def __mul__(self, other):
+        return FastVector3(self.x * other,
+                           self.y * other,
+                           self.z * other)
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return FastVector3(-self.x,
+                           -self.y,
+                           -self.z)
+
+    def __abs__(self):
+        return math.sqrt(self.x ** 2 + \
+                         self.y ** 2 + \
+                         self.z ** 2)
+
+    magnitude = __abs__
+
+    def magnitude_squared(self):
+        return self.x ** 2 + \
+               self.y ** 2 + \
+               self.z ** 2
+
+    def normalize(self):
+        d = self.magnitude()
+        if d:
+            self.x /= d
+            self.y /= d
+            self.z /= d
+        return self
+
+    def normalized(self):
+        d = self.magnitude()
+        if d:
+            return FastVector3(self.x / d,
+                               self.y / d,
+                               self.z / d)
+        return self.copy()
+
+    def dot(self, other):
+        return self.x * other.x + \
+               self.y * other.y + \
+               self.z * other.z
+
+    def cross(self, other):
+        return FastVector3(self.y * other.z - self.z * other.y,
+                           -self.x * other.z + self.z * other.x,
+                           self.x * other.y - self.y * other.x)
+
+# a += s * b in place, without the temporary for s * b.  Works on
+# FastVector3 and Vector3 alike and gives the same numbers as a + s * b.
+def madd(a, s, b):
+    a.x = a.x + s * b.x
+    a.y = a.y + s * b.y
+    a.z = a.z + s * b.z
+    return a
+
+# Many Vector3s at once, stored as one Numeric array per component
+# (struct of arrays).  Operators work on whole arrays and follow Vector3:
+# the other operand may be a Vector3Array of the same length, a single
+# Vector3 (or 3-sequence), and for * and / a scalar or an array with one
+# scalar per vector.  Results keep the typecode (Float or Float32).
+class Vector3Array:
+    __slots__ = ['x', 'y', 'z', 'typecode']
+
+    def __init__(self, x, y, z, typecode=None):
+        if typecode is None:
+            typecode = Numeric.Float
+        self.typecode = typecode
+        self.x = Numeric.asarray(x).astype(typecode)
+        self.y = Numeric.asarray(y).astype(typecode)
+        self.z = Numeric.asarray(z).astype(typecode)
+
+    # From an (N, 3) array
+    def from_array(cls, a, typecode=None):
+        return cls(a[:, 0], a[:, 1], a[:, 2], typecode)
+    from_array = classmethod(from_array)
+
+    def from_vectors(cls, vectors, typecode=None):
+        return cls([v[0] for v in vectors],
+                   [v[1] for v in vectors],
+                   [v[2] for v in vectors], typecode)
+    from_vectors = classmethod(from_vectors)
+
+    def _new(self, x, y, z):
+        return Vector3Array(x, y, z, self.typecode)
+
+    def __copy__(self):
+        return self._new(self.x, self.y, self.z)
+
+    copy = __copy__
+
+    def __repr__(self):
+        return 'Vector3Array(%d vectors)' % len(self)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._new(self.x[key], self.y[key], self.z[key])
+        return Vector3(float(self.x[key]), float(self.y[key]), float(self.z[key]))
+
+    def __iter__(self):
+        return iter(self.to_vectors())
+
+    # As an (N, 3) array
+    def to_array(self):
+        a = Numeric.zeros((len(self), 3), self.typecode)
+        a[:, 0] = self.x
+        a[:, 1] = self.y
+        a[:, 2] = self.z
+        return a
+
+    def to_vectors(self):
+        return map(Vector3, self.x.tolist(), self.y.tolist(), self.z.tolist())
+
+    def _components(self, other):
+        if isinstance(other, Vector3Array):
+            return other.x, other.y, other.z
+        assert hasattr(other, '__len__') and len(other) == 3
+        return other[0], other[1], other[2]
+
+    def __add__(self, other):
+        x, y, z = self._components(other)
+        return self._new(self.x + x, self.y + y, self.z + z)
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        x, y, z = self._components(other)
+        return self._new(self.x - x, self.y - y, self.z - z)
+
+    def __rsub__(self, other):
+        x, y, z = self._components(other)
+        return self._new(x - self.x, y - self.y, z - self.z)
+
+    def __mul__(self, other):
+        return self._new(self.x * other, self.y * other, self.z * other)
+
+    __rmul__ = __mul__
+
+    def __div__(self, other):
+        return self._new(self.x / other, self.y / other, self.z / other)
+
+    __truediv__ = __div__
+
+    def __neg__(self):
+        return self._new(-self.x, -self.y, -self.z)
+
+    def __abs__(self):
+        return Numeric.sqrt(self.magnitude_squared())
+
+    magnitude = __abs__
+
+    def magnitude_squared(self):
+        return self.x ** 2 + \
+               self.y ** 2 + \
+               self.z ** 2
+
+    # Zero length vectors are left alone, like Vector3.normalized()
+    def normalized(self):
+        d = self.magnitude()
+        d = Numeric.where(Numeric.equal(d, 0), 1, d)
+        return self / d
+
+    def normalize(self):
+        n = self.normalized()
+        self.x, self.y, self.z = n.x, n.y, n.z
+        return self
+
+    def dot(self, other):
+        x, y, z = self._components(other)
+        return self.x * x + \
+               self.y * y + \
+               self.z * z
+
+    def cross(self, other):
+        x, y, z = self._components(other)
+        return self._new(self.y * z - self.z * y,
+                         -self.x * z + self.z * x,
+                         self.x * y - self.y * x)
+
 # a b c 
 # e f g 
 # i j k 
@@ -1038,6 +1282,109 @@ class Matrix4:
         return self
     new_perspective = classmethod(new_perspective)
 
+    # Batched operations on Numeric arrays.  Matrices are 4x4 arrays in
+    # row order (a b c d / e f g h / ...), stacks of them (M, 4, 4)
+    # arrays; points and vectors are (N, 3) arrays or Vector3Arrays.
+    # Points are transformed like Matrix4 * Point3 (with translation, no
+    # perspective divide) and vectors like Matrix4 * Vector3, with the
+    # same arithmetic as one at a time.
+
+    def to_array(self):
+        return Numeric.array([[self.a, self.b, self.c, self.d],
+                              [self.e, self.f, self.g, self.h],
+                              [self.i, self.j, self.k, self.l],
+                              [self.m, self.n, self.o, self.p]], Numeric.Float)
+
+    def from_array(cls, a):
+        self = cls()
+        (self.a, self.b, self.c, self.d,
+         self.e, self.f, self.g, self.h,
+         self.i, self.j, self.k, self.l,
+         self.m, self.n, self.o, self.p) = Numeric.ravel(a).tolist()
+        return self
+    from_array = classmethod(from_array)
+
+    # A list of Matrix4 as an (M, 4, 4) array, and back
+    def stack(cls, matrices):
+        return Numeric.array([M.to_array() for M in matrices], Numeric.Float)
+    stack = classmethod(stack)
+
+    def unstack(cls, stack):
+        return [cls.from_array(a) for a in stack]
+    unstack = classmethod(unstack)
+
+    def _transform(self, points, translate):
+        if isinstance(points, Vector3Array):
+            x, y, z = points.x, points.y, points.z
+        else:
+            x, y, z = points[:, 0], points[:, 1], points[:, 2]
+        nx = self.a * x + self.b * y + self.c * z
+        ny = self.e * x + self.f * y + self.g * z
+        nz = self.i * x + self.j * y + self.k * z
+        if translate:
+            nx = nx + self.d
+            ny = ny + self.h
+            nz = nz + self.l
+        if isinstance(points, Vector3Array):
+            return points._new(nx, ny, nz)
+        result = Numeric.zeros((len(x), 3), Numeric.Float)
+        result[:, 0] = nx
+        result[:, 1] = ny
+        result[:, 2] = nz
+        return result
+
+    def transform_points(self, points):
+        return self._transform(points, True)
+
+    def transform_vectors(self, vectors):
+        return self._transform(vectors, False)
+
+    # Pairwise products A[k] * B[k] of two stacks; either may also be a
+    # single Matrix4 or 4x4 array, which is then used for every k.
+    def compose_many(cls, A, B):
+        A = _matrix_stack(A)
+        B = _matrix_stack(B)
+        C = Numeric.zeros((max(len(A), len(B)), 4, 4), Numeric.Float)
+        for r in range(4):
+            for c in range(4):
+                C[:, r, c] = A[:, r, 0] * B[:, 0, c] + A[:, r, 1] * B[:, 1, c] + \
+                             A[:, r, 2] * B[:, 2, c] + A[:, r, 3] * B[:, 3, c]
+        return C
+    compose_many = classmethod(compose_many)
+
+    # Every matrix of a stack applied to the same (N, 3) points.
+    # Returns an (M, N, 3) array.
+    def transform_points_many(cls, stack, points):
+        return _transform_many(_matrix_stack(stack), points, True)
+    transform_points_many = classmethod(transform_points_many)
+
+    def transform_vectors_many(cls, stack, vectors):
+        return _transform_many(_matrix_stack(stack), vectors, False)
+    transform_vectors_many = classmethod(transform_vectors_many)
+
+def _matrix_stack(A):
+    if isinstance(A, Matrix4):
+        A = A.to_array()
+    A = Numeric.asarray(A).astype(Numeric.Float)
+    if len(A.shape) == 2:
+        A = Numeric.reshape(A, (1, 4, 4))
+    return A
+
+def _transform_many(A, points, translate):
+    if isinstance(points, Vector3Array):
+        points = points.to_array()
+    x = points[Numeric.NewAxis, :, 0]
+    y = points[Numeric.NewAxis, :, 1]
+    z = points[Numeric.NewAxis, :, 2]
+    result = Numeric.zeros((len(A), len(points), 3), Numeric.Float)
+    for r in range(3):
+        row = A[:, r, :, Numeric.NewAxis]
+        v = row[:, 0] * x + row[:, 1] * y + row[:, 2] * z
+        if translate:
+            v = v + row[:, 3]
+        result[:, :, r] = v
+    return result
+
 class Quaternion:
     # All methods and naming conventions based off 
     # http://www.euclideanspace.com/maths/algebra/realNormedAlgebra/quaternions
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+"""
+halftone.py - Batched conversion from image colors to nail lengths
+
+Does the same job as get_halftone() in nailcast2.py, but for a whole
+array of sample positions at once.  The results match get_halftone()
+bit for bit.
+
+"""
+
+import os
+import mmap
+import multiprocessing
+import struct
+import weakref
+import Numeric
+
+# The desaturation factors get_halftone() tries, in order.  They are
+# built with the same repeated subtraction so the floating point values
+# are identical (0.7000000000000001 and friends).
+def desaturation_steps():
+    steps = []
+    alpha = 1
+    while not alpha < -0.2:
+        steps.append(alpha)
+        alpha = alpha - 0.1
+    return steps
+
+ALPHAS = desaturation_steps()
+
+
+# Every (x, y) pair of the two axes, x major, as an (N, 2) array.
+# This is the order artwork2() visits the lattice in.
+def lattice(xs, ys):
+    nx = len(xs)
+    ny = len(ys)
+    points = Numeric.zeros((nx * ny, 2), Numeric.Float)
+    points[:, 0] = Numeric.ravel(Numeric.outerproduct(xs, Numeric.ones(ny, Numeric.Float)))
+    points[:, 1] = Numeric.ravel(Numeric.outerproduct(Numeric.ones(nx, Numeric.Float), ys))
+    return points
+
+
+# image_array() of every image still alive
+decoded_images = weakref.WeakKeyDictionary()
+
+# Decode an image into an (width * height, 3) UnsignedInt8 array of RGB
+# values, one byte per channel.  An image is decoded once and the array
+# reused for as long as the image lives, e.g. for both lattice offsets.
+def image_array(im):
+    pixels = decoded_images.get(im)
+    if pixels is None:
+        data = Numeric.fromstring(im.convert("RGB").tostring(), Numeric.UnsignedInt8)
+        pixels = Numeric.reshape(data, (im.size[0] * im.size[1], 3))
+        decoded_images[im] = pixels
+    return pixels
+
+
+# Look up the pixel under each (x, y) position in millimeters.  This is
+# the pixel im.getpixel() returns in get_rgb(): coordinates are truncated.
+# Only the sampled pixels are converted to Float.
+#
+# points          - (N, 2) array of positions in millimeters
+# pixels          - image_array() of the image
+# width           - width of the image in pixels
+# canvas_width_mm - how wide the image is stretched on the board
+def sample_rgb(points, pixels, width, canvas_width_mm):
+    pixels_per_mm = width / canvas_width_mm
+    ix = (points[:, 0] * pixels_per_mm).astype(Numeric.Int)
+    iy = (points[:, 1] * pixels_per_mm).astype(Numeric.Int)
+    return Numeric.take(pixels, iy * width + ix, 0).astype(Numeric.Float)
+
+
+def rgb2abc(r, g, b):
+    return ((r - g - b + 255) / 255.0,
+            (- r + g - b + 255) / 255.0,
+            (- r - g + b + 255) / 255.0)
+
+
+def _in_range(v):
+    return Numeric.logical_and(Numeric.greater_equal(v, 0),
+                               Numeric.less_equal(v, 1))
+
+
+# Largest desaturation factor that keeps a, b and c in [0, 1].
+#
+# Blending towards the luma y makes each nail length linear in alpha:
+#   255 * a = alpha * (r - g - b + y) + 255 - y
+# and alpha = 0 (pure gray) always fits, so each channel only gives an
+# upper bound on alpha.
+def max_alpha(r, g, b, y):
+    hi = Numeric.ones(r.shape, Numeric.Float)
+    for s in (r - g - b + y, - r + g - b + y, - r - g + b + y):
+        safe = Numeric.where(Numeric.equal(s, 0), 1.0, s)
+        bound = Numeric.where(Numeric.greater(s, 0), y / safe,
+                              Numeric.where(Numeric.less(s, 0),
+                                            (255 - y) / -safe, 1.0))
+        hi = Numeric.minimum(hi, bound)
+    return hi
+
+
+# rgb - (N, 3) array of colors
+# Returns an (N, 3) array of nail lengths a, b, c.
+def rgb_to_halftone(rgb):
+    r = rgb[:, 0]
+    g = rgb[:, 1]
+    b = rgb[:, 2]
+    y = Numeric.floor(0.299 * r + 0.587 * g + 0.114 * b + 0.5)
+    alphas = Numeric.array(ALPHAS, Numeric.Float)
+    last = len(ALPHAS) - 1
+
+    # Start one step early in case rounding put the bound on the wrong
+    # side of a step, then walk forward with the exact iterative math.
+    step = Numeric.ceil(10 * (1 - max_alpha(r, g, b, y))) - 1
+    step = Numeric.clip(step, 0, last).astype(Numeric.Int)
+    done = Numeric.zeros(r.shape, Numeric.Int)
+    result = [Numeric.zeros(r.shape, Numeric.Float)] * 3
+    for i in range(len(ALPHAS)):
+        alpha = Numeric.take(alphas, step)
+        abc = rgb2abc(alpha * r + (1 - alpha) * y,
+                      alpha * g + (1 - alpha) * y,
+                      alpha * b + (1 - alpha) * y)
+        ok = Numeric.logical_and(_in_range(abc[0]), _in_range(abc[1]))
+        ok = Numeric.logical_and(ok, _in_range(abc[2]))
+        ok = Numeric.logical_and(ok, Numeric.logical_not(done))
+        result = [Numeric.where(ok, abc[k], result[k]) for k in range(3)]
+        done = Numeric.logical_or(done, ok)
+        if Numeric.alltrue(done):
+            break
+        step = Numeric.minimum(step + 1, last)
+
+    # Colors no step could fix keep the last attempt, like get_halftone().
+    for k in Numeric.nonzero(Numeric.logical_not(done)):
+        print "bug - why can't we find RGB %d %d %d" % tuple(rgb[k])
+    result = [Numeric.where(done, result[k], abc[k]) for k in range(3)]
+    return Numeric.transpose(Numeric.array(result))
+
+
+# Nail lengths for every (x, y) position in millimeters.  With a
+# HalftoneLUT the colors are looked up instead of solved.
+def get_halftones(points, im, canvas_width_mm, lut=None):
+    rgb = sample_rgb(points, image_array(im), im.size[0], canvas_width_mm)
+    if lut is not None:
+        return lut.Halftones(rgb)
+    return rgb_to_halftone(rgb)
+
+
+# Where HalftoneLUT keeps its cache files.
+LUT_DIR = "/tmp"
+
+# Bump whenever rgb_to_halftone() or the binning changes, so stale
+# caches are rebuilt.
+LUT_VERSION = 3
+
+# Precomputed nail lengths for every color, quantized to `bits` bits per
+# channel (6 bits gives 64 bins per channel).  Each channel has its n
+# bins plus two extra slots for exactly 0 and exactly 255, so pure
+# channels stay exact at any depth; the other values take the result for
+# their bin's centre.  The table is built once and cached on disk, and
+# lookups read the entries they need straight from the memory mapped
+# file instead of loading the table.  With bits = 8 the table is exact.
+class HalftoneLUT:
+    def __init__(self, bits=6, cachedir=LUT_DIR):
+        self.bits = bits
+        self.shift = 8 - bits
+        self.n = 1 << bits
+        self.slots = self.n + 2
+        self.path = os.path.join(cachedir, "nailcast-lut-v%d-%dbit.bin" %
+                                 (LUT_VERSION, bits))
+        if not os.path.exists(self.path):
+            self.Build()
+        f = open(self.path, "rb")
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+
+    # Representative colors of table entries start .. stop - 1.  Slot 0
+    # of a channel is 0, slot n + 1 is 255 and slot k in between is the
+    # centre of bin k - 1.
+    def BinColors(self, start, stop):
+        m = self.slots
+        width = 1 << self.shift
+        index = Numeric.arange(start, stop)
+        rgb = Numeric.zeros((stop - start, 3), Numeric.Float)
+        for c, s in enumerate((index / (m * m), index / m % m, index % m)):
+            centre = (s - 1) * width + (width - 1) / 2.0
+            rgb[:, c] = Numeric.where(Numeric.equal(s, 0), 0,
+                                      Numeric.where(Numeric.equal(s, m - 1), 255, centre))
+        return rgb
+
+    # Solve the table `chunk` entries at a time, straight into the file,
+    # so building even the 8 bit table stays small.
+    def Build(self, chunk=1 << 16):
+        size = self.slots * self.slots * self.slots
+        # Write under a temporary name so a concurrent run never maps a
+        # half written table.
+        tmpname = "%s.%d" % (self.path, os.getpid())
+        f = open(tmpname, "wb")
+        for start in range(0, size, chunk):
+            rgb = self.BinColors(start, min(start + chunk, size))
+            f.write(rgb_to_halftone(rgb).astype(Numeric.Float).tostring())
+        f.close()
+        os.rename(tmpname, self.path)
+
+    def Slot(self, v):
+        if v <= 0:
+            return 0
+        if v >= 255:
+            return self.slots - 1
+        return (int(v) >> self.shift) + 1
+
+    def Index(self, rgb):
+        m = self.slots
+        return (self.Slot(rgb[0]) * m + self.Slot(rgb[1])) * m + self.Slot(rgb[2])
+
+    # Nail lengths (a, b, c) for one pixel value.
+    def Lookup(self, rgb):
+        return struct.unpack_from("3d", self.map, self.Index(rgb) * 24)
+
+    # Table indices of an (N, 3) array of colors.
+    def Indices(self, rgb):
+        s = (Numeric.clip(rgb, 0, 255).astype(Numeric.Int) >> self.shift) + 1
+        s = Numeric.where(Numeric.less_equal(rgb, 0), 0, s)
+        s = Numeric.where(Numeric.greater_equal(rgb, 255), self.slots - 1, s)
+        m = self.slots
+        return (s[:, 0] * m + s[:, 1]) * m + s[:, 2]
+
+    # rgb - (N, 3) array of colors
+    # Returns an (N, 3) array of nail lengths a, b, c, gathered entry by
+    # entry from the mapped file.
+    def Halftones(self, rgb):
+        m = self.map
+        data = "".join([m[i:i + 24] for i in (self.Indices(rgb) * 24).tolist()])
+        return Numeric.reshape(Numeric.fromstring(data, Numeric.Float), (len(rgb), 3))
+
+
+# What the sampling workers share: the decoded image, its width, the
+# canvas width and the lookup table.  Set before the pool is created, so
+# the forked workers see the parent's arrays (copy on write) instead of
+# each receiving a pickled copy.
+shared_image = None
+
+def halftone_chunk(points):
+    pixels, width, canvas_width_mm, lut = shared_image
+    rgb = sample_rgb(points, pixels, width, canvas_width_mm)
+    if lut is not None:
+        return lut.Halftones(rgb)
+    return rgb_to_halftone(rgb)
+
+# get_halftones() with the points split into chunks of `chunk` samples
+# and spread over a pool of worker processes.  Small jobs run inline.
+def get_halftones_parallel(points, im, canvas_width_mm, lut=None,
+                           processes=None, chunk=65536):
+    return solve_parallel(points, image_array(im), im.size[0], canvas_width_mm,
+                          lut, processes, chunk)
+
+# get_halftones_parallel() on an image_array()
+def solve_parallel(points, pixels, width, canvas_width_mm, lut=None,
+                   processes=None, chunk=65536):
+    global shared_image
+    shared_image = (pixels, width, canvas_width_mm, lut)
+    try:
+        if len(points) <= chunk or processes == 1:
+            return halftone_chunk(points)
+        chunks = [points[i:i + chunk] for i in range(0, len(points), chunk)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            return Numeric.concatenate(pool.map(halftone_chunk, chunks))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shared_image = None
+
+
+# Names how get_halftones() turns colors into nail lengths with this
+# lut, for cache keys.
+def halftone_method(lut=None):
+    if lut is None:
+        return "exact %s" % repr(ALPHAS)
+    return "lut %d %d" % (LUT_VERSION, lut.bits)
+
+
+# get_halftones() through a TileCache: the image is cut into tiles of
+# tile x tile pixels and the nail lengths of the points falling in each
+# tile are cached under the tile's pixels, the points themselves and the
+# lookup table in use.  After retouching a region only the tiles it
+# touches are recomputed, all together through solve_parallel().
+def get_halftones_cached(points, im, canvas_width_mm, cache, lut=None, tile=64,
+                         processes=None):
+    pixels = image_array(im)
+    width, height = im.size
+    pixels_per_mm = width / canvas_width_mm
+    ix = (points[:, 0] * pixels_per_mm).astype(Numeric.Int)
+    iy = (points[:, 1] * pixels_per_mm).astype(Numeric.Int)
+    tiles_x = (width + tile - 1) / tile
+    tile_id = (iy / tile) * tiles_x + ix / tile
+    method = halftone_method(lut)
+
+    result = Numeric.zeros((len(points), 3), Numeric.Float)
+    # Sort by tile, keeping the point order within a tile
+    order = Numeric.argsort(tile_id * len(points) + Numeric.arange(len(points)))
+    sorted_ids = Numeric.take(tile_id, order)
+    # Start of every run of equal tile ids
+    starts = [0] + list(Numeric.nonzero(Numeric.not_equal(sorted_ids[1:], sorted_ids[:-1])) + 1)
+    missed = []
+    for k in range(len(starts)):
+        if not len(order):
+            break
+        end = k + 1 < len(starts) and starts[k + 1] or len(order)
+        members = order[starts[k]:end]
+        t = sorted_ids[starts[k]]
+        tx = t % tiles_x * tile
+        ty = t / tiles_x * tile
+        block = Numeric.reshape(pixels, (height, width, 3))[ty:ty + tile, tx:tx + tile]
+        tile_points = Numeric.take(points, members, 0)
+        key = cache.Key("halftone", method, canvas_width_mm, width,
+                        block.tostring(), tile_points.tostring())
+        data = cache.Get(key)
+        if data is None:
+            missed.append((key, members))
+            continue
+        values = Numeric.reshape(Numeric.fromstring(data, Numeric.Float),
+                                 (len(members), 3))
+        for c in range(3):
+            Numeric.put(result, members * 3 + c, values[:, c])
+
+    if missed:
+        members = Numeric.concatenate([m for key, m in missed])
+        solved = solve_parallel(Numeric.take(points, members, 0), pixels, width,
+                                canvas_width_mm, lut, processes)
+        for c in range(3):
+            Numeric.put(result, members * 3 + c, solved[:, c])
+        start = 0
+        for key, m in missed:
+            cache.Put(key, solved[start:start + len(m)].astype(Numeric.Float).tostring())
+            start = start + len(m)
+    return result
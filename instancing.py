@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+instancing.py - Tessellate a shape once, place it many times
+
+A Prototype is a shape tessellated once, with every facet corner given
+as an anchor point plus a scaled offset:
+
+    corner = anchor[a] + scale[s] * offset
+
+Instances supply their own anchors and scales as arrays, one row per
+instance, so placing thousands of nails or cylinders is a handful of
+array operations.  Prototypes are cached by (shape, precision,
+direction).
+
+"""
+
+import math
+import Numeric
+
+class Prototype:
+    def __init__(self):
+        self.corners = []
+        self.groups = []
+        self.packed = None
+
+    # corners - three (anchor, scale, offset) triples
+    # group   - the POV group of the facet
+    def AddFacet(self, corners, group=0):
+        self.corners.append(corners)
+        self.groups.append(group)
+        self.packed = None
+
+    def __len__(self):
+        return len(self.corners)
+
+    # Corner c of every facet as (anchor indices, scale indices, offsets)
+    def Corner(self, c):
+        if self.packed is None:
+            self.packed = []
+            for k in range(3):
+                anchor = Numeric.array([f[k][0] for f in self.corners], Numeric.Int)
+                scale = Numeric.array([f[k][1] for f in self.corners], Numeric.Int)
+                offset = Numeric.array([list(f[k][2]) for f in self.corners], Numeric.Float)
+                self.packed.append((anchor, scale, offset))
+        return self.packed[c]
+
+    # Place M instances.
+    #
+    # anchors - list of (M, 3) arrays, the anchor points of each instance
+    # scales  - list of (M,) arrays or plain numbers
+    # Returns v1, v2, v3 as (M * F, 3) arrays and the (M * F,) groups,
+    # instance by instance in facet order.
+    def Instantiate(self, anchors, scales):
+        m = len(anchors[0])
+        f = len(self)
+        # (M, A, 3) and (M, S)
+        anchors = Numeric.concatenate([Numeric.reshape(a, (m, 1, 3)) for a in anchors], 1)
+        scale_array = Numeric.zeros((m, len(scales)), Numeric.Float)
+        for s in range(len(scales)):
+            scale_array[:, s] = scales[s]
+        v = []
+        for c in range(3):
+            anchor, scale, offset = self.Corner(c)
+            base = Numeric.take(anchors, anchor, 1)
+            stretch = Numeric.take(scale_array, scale, 1)
+            corner = base + stretch[:, :, Numeric.NewAxis] * offset[Numeric.NewAxis, :, :]
+            v.append(Numeric.reshape(corner, (m * f, 3)))
+        group = Numeric.resize(Numeric.array(self.groups), (m * f,))
+        return v[0], v[1], v[2], group
+
+
+prototypes = {}
+
+# The prototype for key = (shape, precision, direction), made with
+# build() the first time it is asked for.
+def GetPrototype(key, build):
+    prototype = prototypes.get(key)
+    if prototype is None:
+        prototype = build()
+        prototypes[key] = prototype
+    return prototype
+
+
+# The cylinder STL.AddCylinder() draws, with prec segments.
+# Anchors: bottom, top.  Scales: radius, trsize (the base triangle).
+# Each segment gives a side quad and a slice of the top; the bottom is
+# closed by one triangle.
+def CylinderPrototype(prec):
+    BOTTOM, TOP = 0, 1
+    RADIUS, TRSIZE = 0, 1
+    zero = (0, 0, 0)
+    cylinder = Prototype()
+    dangle = 2 * math.pi / prec
+    for i in range(0, prec):
+        a0 = i * dangle
+        a1 = a0 + dangle
+        r0 = (math.cos(a0), math.sin(a0), 0)
+        r1 = (math.cos(a1), math.sin(a1), 0)
+        cylinder.AddFacet(((BOTTOM, RADIUS, r0), (BOTTOM, RADIUS, r1), (TOP, RADIUS, r1)))
+        cylinder.AddFacet(((TOP, RADIUS, r1), (TOP, RADIUS, r0), (BOTTOM, RADIUS, r0)))
+        cylinder.AddFacet(((TOP, RADIUS, zero), (TOP, RADIUS, r0), (TOP, RADIUS, r1)))
+    trpoints = [(math.cos((2*i+1)*math.pi/3), math.sin((2*i+1)*math.pi/3), 0)
+                for i in range(0, 3)]
+    cylinder.AddFacet([(BOTTOM, TRSIZE, p) for p in trpoints])
+    return cylinder
+
+# The nail MeshGenerator.AddTriangle() draws: a triangular prism from the
+# cell's base triangle along the light direction `light`.
+# Anchors: the three base corners.  Scale: the nail length in mm.
+# Facets: the tip, then two per side, in AddTriangle() order.
+def PrismPrototype(light):
+    LENGTH = 0
+    zero = (0, 0, 0)
+    light = tuple(light)
+    base = [(k, LENGTH, zero) for k in range(3)]
+    top = [(k, LENGTH, light) for k in range(3)]
+    prism = Prototype()
+    prism.AddFacet((top[0], top[1], top[2]))
+    for k in range(0, 3):
+        k1 = (k + 1) % 3
+        prism.AddFacet((base[k], base[k1], top[k1]))
+        prism.AddFacet((base[k], top[k1], top[k]))
+    return prism
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+instrument.py - Opt-in timers and counters
+
+    with instrument.Span("render"):
+        ...
+    instrument.Count("facets", n)
+
+Nothing is recorded until Enable() is called, so the calls can stay in
+the code at the cost of a flag test.  WriteChromeTrace() saves what was
+recorded in the Chrome trace event format; load the file in
+chrome://tracing or https://ui.perfetto.dev to see the stages on a
+timeline, with the peak memory at the end of every span and the
+counters as graphs.
+
+"""
+
+import os
+import json
+import time
+import resource
+
+enabled = False
+events = []
+counters = {}
+origin = time.time()
+
+def Enable():
+    global enabled, origin
+    enabled = True
+    origin = time.time()
+    del events[:]
+    counters.clear()
+
+# Microseconds since Enable()
+def Now():
+    return int((time.time() - origin) * 1e6)
+
+def PeakMB():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# Times the block it wraps.  args are shown with the span in the trace.
+class Span:
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if enabled:
+            self.start = Now()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if enabled:
+            args = dict(self.args)
+            args["peak_mb"] = round(PeakMB(), 1)
+            events.append({"name": self.name, "ph": "X", "ts": self.start,
+                           "dur": Now() - self.start, "pid": os.getpid(),
+                           "tid": 0, "args": args})
+        return False
+
+# Add n to the counter called name
+def Count(name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+        events.append({"name": name, "ph": "C", "ts": Now(), "pid": os.getpid(),
+                       "args": {name: counters[name]}})
+
+def WriteChromeTrace(fname):
+    f = open(fname, "w")
+    json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    f.close()
+
+# One line per span name: calls and total seconds, then the counters
+def Summary():
+    totals = {}
+    for event in events:
+        if event["ph"] == "X":
+            calls, dur = totals.get(event["name"], (0, 0))
+            totals[event["name"]] = (calls + 1, dur + event["dur"])
+    lines = ["%-20s %6d calls %9.3fs" % (name, calls, dur / 1e6)
+             for name, (calls, dur) in sorted(totals.items())]
+    lines += ["%-20s %d" % (name, n) for name, n in sorted(counters.items())]
+    return "\n".join(lines)
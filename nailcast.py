@@ -16,7 +16,9 @@ import math
 import Image
 import ImageChops
 import ImageFilter
+from halftone import HalftoneLUT
 display_prog = 'rsvg' # Command to execute to display images.
+lut_bits = None # color resolution of the halftone lookup table, None to solve exactly
 
 class Scene:
     def __init__(self,name="svg",height=400,width=400):
@@ -187,16 +189,24 @@ def get_cell_color_analytic(x,y,im):
         alpha = alpha - 0.1
     return (a, b, c)
 
-def artwork(scene, offset, s, r, im):
+# Same as get_cell_color_analytic(), read from a precomputed table
+def get_cell_color_lut(x, y, im, lut):
+    return lut.Lookup(im.getpixel((x,y)))
+
+def artwork(scene, offset, s, r, im, lut=None):
+    if lut:
+        get_cell_color = lambda x, y, im: get_cell_color_lut(x, y, im, lut)
+    else:
+        get_cell_color = get_cell_color_analytic
     ctr = 0
     for y in range(int(offset[1]), im.size[1], int(r*4)):
         if y >= 0:
             for x in range(offset[0], im.size[0], s):
                 ctr += Pyramid(scene,(x, y),
-                               s, r, get_cell_color_analytic(x, y, im))
+                               s, r, get_cell_color(x, y, im))
             for x in range(offset[0] + s/2, im.size[0], s):
                 ctr += Pyramid(scene,(x, y + 2 * r),
-                               s, r, get_cell_color_analytic(x, y, im))
+                               s, r, get_cell_color(x, y, im))
     return ctr
 
 def portrait(argv=None):
@@ -222,8 +232,11 @@ def portrait(argv=None):
     scene = Scene(stem, im.size[1], im.size[0])
     makeitwork = math.tan(math.pi / 6) * 0.5 * s
     scene.add(Rectangle((0,0),im.size[1], im.size[0], (255,255,255)))
-    count = artwork(scene, (0, r), s, r, im)
-    count += artwork(scene, (s / 2, r - makeitwork), s, r, im)
+    lut = None
+    if lut_bits:
+        lut = HalftoneLUT(lut_bits)
+    count = artwork(scene, (0, r), s, r, im, lut)
+    count += artwork(scene, (s / 2, r - makeitwork), s, r, im, lut)
     scene.write_svg()
     print "%d nails, cell size %0.1f mm (%0.1f pixels)" % (count, 
                                                            triangle_side_mm,
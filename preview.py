@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+preview.py - Quick shadow preview of a nail board
+
+Rasterizes the shadows POV-Ray would render for /tmp/main.pov, straight
+from the nail list of a MeshGenerator: a top down orthographic view of
+the white board lit by the red, green and blue lights.  Takes seconds
+instead of a full POV-Ray render.
+
+"""
+
+import math
+import Numeric
+import Image
+
+# Every nail is a prism over one small lattice triangle (side dx), so its
+# shadow is that triangle swept along the shadow direction.  We stamp
+# the triangle as a cloud of points, one sample per pixel or so.
+#
+# Returns (N, 2) offsets in mm from the apex of the triangle.
+def TriangleSamples(dx, dy, step):
+    samples = []
+    rows = max(1, int(math.ceil(dy / step)))
+    for r in range(rows + 1):
+        t = float(r) / rows
+        half = 0.5 * dx * t
+        cols = max(1, int(math.ceil(2 * half / step)))
+        for c in range(cols + 1):
+            samples.append((-half + 2 * half * c / cols, dy * t))
+    return Numeric.array(samples, Numeric.Float)
+
+# Clear every pixel under the points (x, y) in mm in a mask image
+def Stamp(mask, x, y, pixels_per_mm):
+    height, width = mask.shape
+    ix = Numeric.floor(x * pixels_per_mm).astype(Numeric.Int)
+    iy = Numeric.floor(y * pixels_per_mm).astype(Numeric.Int)
+    inside = Numeric.logical_and(Numeric.logical_and(Numeric.greater_equal(ix, 0),
+                                                     Numeric.less(ix, width)),
+                                 Numeric.logical_and(Numeric.greater_equal(iy, 0),
+                                                     Numeric.less(iy, height)))
+    index = Numeric.compress(inside, iy * width + ix)
+    Numeric.put(mask, index, 0)
+
+# Sweep the nail triangles from their base along dx, dy (arrays, in mm)
+# and clear the covered pixels.
+def Sweep(mask, apex_x, apex_y, dx, dy, samples, pixels_per_mm):
+    length = Numeric.sqrt(dx * dx + dy * dy)
+    if not len(length):
+        return
+    steps = int(math.ceil(Numeric.maximum.reduce(length) * pixels_per_mm)) + 1
+    for k in range(steps + 1):
+        t = float(k) / steps
+        for sx, sy in samples.tolist():
+            Stamp(mask, apex_x + sx + t * dx, apex_y + sy + t * dy, pixels_per_mm)
+
+# Render the shadow image of a mesh whose extent and nail keys are known
+# (MeshGenerator.GetExtent() has run).
+#
+# mesh          - MeshGenerator with its nails
+# lights        - the three light directions, LightDirection(0..2)
+# pixels_per_mm - resolution of the preview
+# Returns a PIL RGB image, oriented like the POV-Ray render.
+def RenderShadows(mesh, lights, pixels_per_mm=4.0):
+    width = int(math.ceil(mesh.nx * mesh.dx * pixels_per_mm))
+    height = int(math.ceil(mesh.ny * mesh.dy * pixels_per_mm))
+    # One mask per light: 1 where the board is lit by it
+    lit = [Numeric.ones((height, width), Numeric.UnsignedInt8) for light in lights]
+    # Nail bodies are black and hide the board from the camera
+    board = Numeric.ones((height, width), Numeric.UnsignedInt8)
+
+    x, y, direction, length = mesh.nails.Columns()
+    kx, ky = mesh.NailKeys()
+    apex_x = kx * 0.5 * mesh.dx
+    apex_y = ky * 0.5 * mesh.dy
+    length_mm = mesh.triangle_side_mm * 5.0 / 6.0 * length
+    samples = TriangleSamples(mesh.dx, mesh.dy, 1.0 / pixels_per_mm)
+
+    for d in range(len(lights)):
+        # The nails pointing at light d
+        mine = Numeric.equal(direction, d)
+        ax = Numeric.compress(mine, apex_x)
+        ay = Numeric.compress(mine, apex_y)
+        l = Numeric.compress(mine, length_mm)
+        # A nail's tip sits at length * light[d] below the board; the
+        # parallel light from light k throws it back onto the board at
+        # length * (light[d] - light[k]).
+        for k in range(len(lights)):
+            if k == d:
+                continue
+            Sweep(lit[k], ax, ay,
+                  l * (lights[d].x - lights[k].x),
+                  l * (lights[d].y - lights[k].y),
+                  samples, pixels_per_mm)
+        Sweep(board, ax, ay, l * lights[d].x, l * lights[d].y,
+              samples, pixels_per_mm)
+
+    rgb = Numeric.zeros((height, width, 3), Numeric.UnsignedInt8)
+    for k in range(len(lights)):
+        rgb[:, :, k] = (lit[k] * board * 255).astype(Numeric.UnsignedInt8)
+    im = Image.fromstring("RGB", (width, height), rgb.tostring())
+    return im.transpose(Image.FLIP_TOP_BOTTOM)
+
+def WritePreview(mesh, lights, fname, pixels_per_mm=4.0):
+    RenderShadows(mesh, lights, pixels_per_mm).save(fname)
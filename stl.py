@@ -1,5 +1,13 @@
 #!/usr/bin/python
+import os
+import sys
+import json
 import struct
+import shutil
+import tempfile
+import Numeric
+import instrument
+from instancing import GetPrototype, CylinderPrototype
 from euclid import *
 from math import *
 
@@ -22,38 +30,249 @@ class STLFacet:
                                      PrintVector(self.coords[2]),
                                      PrintVector(self.coords[3]))
 
+# STLFacet's normal and validity without any Vector3 temporaries.
+# v1, v2, v3 - anything indexable as [0], [1], [2]: tuples, Vector3s
+# Returns (nx, ny, nz, valid) with the numbers STLFacet computes.
+def FacetNormal(v1, v2, v3):
+  ax = v2[0] - v1[0]
+  ay = v2[1] - v1[1]
+  az = v2[2] - v1[2]
+  bx = v3[0] - v1[0]
+  by = v3[1] - v1[1]
+  bz = v3[2] - v1[2]
+  nx = ay * bz - az * by
+  ny = -ax * bz + az * bx
+  nz = ax * by - ay * bx
+  magnitude_squared = nx ** 2 + ny ** 2 + nz ** 2
+  if magnitude_squared > 1E-4:
+    d = sqrt(magnitude_squared)
+    return nx / d, ny / d, nz / d, 1
+  return nx, ny, nz, 0
+
+# STLFacet for whole arrays of triangles.
+#
+# v1, v2, v3 - (N, 3) arrays of vertices
+# Returns the (N, 3) unit normals and an (N,) array that is 1 where the
+# facet is valid (not degenerate), using the same arithmetic as STLFacet.
+def FacetNormals(v1, v2, v3):
+  e1 = Vector3Array.from_array(v2 - v1)
+  e2 = Vector3Array.from_array(v3 - v1)
+  normal = e1.cross(e2)
+  magnitude_squared = normal.magnitude_squared()
+  valid = Numeric.greater(magnitude_squared, 1E-4)
+  d = Numeric.sqrt(Numeric.where(valid, magnitude_squared, 1.0))
+  return (normal / d).to_array(), valid
+
+# Binary STL records for arrays of facets, as one string: 50 bytes per
+# facet (normal, v1, v2, v3 as float32, then the attribute byte count),
+# exactly what AddFacet() packs one field at a time.
+def FacetRecords(normals, v1, v2, v3, att_bc=0):
+  n = len(normals)
+  coords = Numeric.zeros((n, 12), Numeric.Float32)
+  coords[:, 0:3] = normals.astype(Numeric.Float32)
+  coords[:, 3:6] = v1.astype(Numeric.Float32)
+  coords[:, 6:9] = v2.astype(Numeric.Float32)
+  coords[:, 9:12] = v3.astype(Numeric.Float32)
+  # View the floats as 24 shorts per facet so the attribute fits in as
+  # a 25th column.
+  words = Numeric.reshape(Numeric.fromstring(coords.tostring(), Numeric.UnsignedInt16),
+                          (n, 24))
+  attr = Numeric.zeros((n, 1), Numeric.UnsignedInt16) + att_bc
+  return Numeric.concatenate((words, attr.astype(Numeric.UnsignedInt16)), 1).tostring()
+
+# digits - decimals per coordinate
+def PrintTriangles(v1, v2, v3, digits=1):
+  coords = Numeric.zeros((len(v1), 9), Numeric.Float)
+  coords[:, 0:3] = v1
+  coords[:, 3:6] = v2
+  coords[:, 6:9] = v3
+  vector = "<%%.%df,%%.%df,%%.%df>" % (digits, digits, digits)
+  triangle = "triangle{%s,%s,%s}" % (vector, vector, vector)
+  return [triangle % tuple(c) for c in coords.tolist()]
+
+def PrintVectors(v):
+  return ["<%.1f,%.1f,%.1f>" % tuple(c) for c in v.tolist()]
+
+# One POV mesh{} of triangle{} entries.  The triangles are streamed to a
+# scratch file and copied into the .pov file at the end, so they never
+# pile up in memory.
+class POVTriangleGroup:
+  # f - scratch file to stream to, an anonymous temporary file by default
+  def __init__(self, f=None):
+    self.f = f or tempfile.TemporaryFile()
+
+  def AddFacet(self, facet):
+    print >>self.f, facet.Print(None)
+
+  def AddRawFacet(self, v1, v2, v3):
+    print >>self.f, "triangle{%s,%s,%s}" % (PrintVector(v1), PrintVector(v2),
+                                             PrintVector(v3))
+
+  # The POV text of arrays of triangles, for AddFormatted().  Format()
+  # can run in another process, leaving only the writing to this one.
+  def Format(self, v1, v2, v3):
+    return "\n".join(PrintTriangles(v1, v2, v3))
+
+  def AddFormatted(self, text):
+    if text:
+      print >>self.f, text
+
+  def AddTriangles(self, v1, v2, v3):
+    self.AddFormatted(self.Format(v1, v2, v3))
+
+  def Write(self, pov, color):
+    print >>pov, "mesh{"
+    self.f.seek(0)
+    shutil.copyfileobj(self.f, pov)
+    self.f.close()
+    print >>pov, "pigment{color rgb%s}" % color
+    print >>pov, "}"
+
+# Stands in for the POV groups when no POV include is wanted
+class POVNullGroup:
+  def AddFacet(self, facet):
+    pass
+
+  def AddRawFacet(self, v1, v2, v3):
+    pass
+
+  def Format(self, v1, v2, v3):
+    return None
+
+  def AddFormatted(self, text):
+    pass
+
+  def AddTriangles(self, v1, v2, v3):
+    pass
+
+  def Write(self, pov, color):
+    pass
+
+# One POV mesh2{} with shared vertices: each distinct vertex (as printed)
+# is written once and faces refer to it by index.  Vertices and faces are
+# streamed to scratch files; only the vertex index stays in memory, and
+# it grows with the board, so the include is about half the size of
+# triangle{} lists but takes about twice as long to write.  Off unless
+# asked for.
+class POVMesh2Group:
+  def __init__(self):
+    self.vertices = {}
+    self.vertexfile = tempfile.TemporaryFile()
+    self.facefile = tempfile.TemporaryFile()
+    self.nfaces = 0
+
+  def VertexIndex(self, v):
+    i = self.vertices.get(v)
+    if i is None:
+      i = len(self.vertices)
+      self.vertices[v] = i
+      self.vertexfile.write(",\n" + v)
+    return i
+
+  def AddFace(self, p1, p2, p3):
+    a = self.VertexIndex(p1)
+    b = self.VertexIndex(p2)
+    c = self.VertexIndex(p3)
+    # Triangles that collapse at print precision would be dropped by
+    # POV-Ray anyway
+    if a == b or b == c or a == c:
+      return
+    self.facefile.write(",\n<%d,%d,%d>" % (a, b, c))
+    self.nfaces = self.nfaces + 1
+
+  def AddFacet(self, facet):
+    self.AddRawFacet(facet.coords[1], facet.coords[2], facet.coords[3])
+
+  def AddRawFacet(self, v1, v2, v3):
+    self.AddFace(PrintVector(v1), PrintVector(v2), PrintVector(v3))
+
+  # The triangles as their own little mesh2: the distinct printed
+  # vertices in order of appearance and an (N, 3) array of faces indexing
+  # them.  AddFormatted() then looks up each distinct vertex once.
+  def Format(self, v1, v2, v3):
+    local = {}
+    vertices = []
+    faces = []
+    for corners in zip(PrintVectors(v1), PrintVectors(v2), PrintVectors(v3)):
+      face = []
+      for p in corners:
+        i = local.get(p)
+        if i is None:
+          i = len(vertices)
+          local[p] = i
+          vertices.append(p)
+        face.append(i)
+      faces.append(face)
+    return vertices, Numeric.array(faces, Numeric.Int32)
+
+  def AddFormatted(self, formatted):
+    vertices, faces = formatted
+    if not len(faces):
+      return
+    ids = Numeric.array([self.VertexIndex(p) for p in vertices], Numeric.Int)
+    faces = Numeric.reshape(Numeric.take(ids, Numeric.ravel(faces)), (len(faces), 3))
+    # Triangles that collapse at print precision, as in AddFace()
+    keep = Numeric.logical_and(Numeric.not_equal(faces[:, 0], faces[:, 1]),
+                               Numeric.not_equal(faces[:, 1], faces[:, 2]))
+    keep = Numeric.logical_and(keep, Numeric.not_equal(faces[:, 0], faces[:, 2]))
+    faces = Numeric.compress(keep, faces, 0)
+    self.facefile.write("".join([",\n<%d,%d,%d>" % tuple(f) for f in faces.tolist()]))
+    self.nfaces = self.nfaces + len(faces)
+
+  def AddTriangles(self, v1, v2, v3):
+    self.AddFormatted(self.Format(v1, v2, v3))
+
+  def Write(self, pov, color):
+    if self.nfaces:
+      print >>pov, "mesh2{"
+      pov.write("vertex_vectors{%d" % len(self.vertices))
+      self.vertexfile.seek(0)
+      shutil.copyfileobj(self.vertexfile, pov)
+      print >>pov, "}"
+      pov.write("face_indices{%d" % self.nfaces)
+      self.facefile.seek(0)
+      shutil.copyfileobj(self.facefile, pov)
+      print >>pov, "}"
+      print >>pov, "pigment{color rgb%s}" % color
+      print >>pov, "}"
+    self.vertexfile.close()
+    self.facefile.close()
+
 class STL:
-  def __init__(self, fname, povname, header):
+  # povname - POV include to write as well, or None
+  # mesh2   - write the POV include as mesh2{} blocks with shared vertices
+  #           instead of lists of triangle{}
+  def __init__(self, fname, povname, header, mesh2=False):
     self.f = open(fname, "w")
-    self.pov = open(povname, "w")
+    self.pov = povname and open(povname, "w")
     self.facedata = []
     self.nfaces = 0
 
     # Write Header
     out = ['%-80.80s' % header]
     # Temporarily set # of faces to 0
-    out.append(struct.pack('L',0))
+    out.append(struct.pack('<I',0))
     self.f.write(''.join(out))
-    self.povgroups = [[], []]
+    if not povname:
+      self.povgroups = [POVNullGroup(), POVNullGroup()]
+    elif mesh2:
+      self.povgroups = [POVMesh2Group(), POVMesh2Group()]
+    else:
+      self.povgroups = [POVTriangleGroup(), POVTriangleGroup()]
 
   def Close(self):
     self.Flush()
     self.f.seek(80);
     out = []
-    out.append(struct.pack('L', self.nfaces))
+    # The count is a little endian uint32 right after the 80 byte header
+    out.append(struct.pack('<I', self.nfaces))
     self.f.write(''.join(out))
     self.f.close()
-    print >>self.pov, "mesh{"
-    for s in self.povgroups[0]:
-      print >>self.pov, s
-    print >>self.pov, "pigment{color rgb<0,0,0>}"
-    print >>self.pov, "}"
-    print >>self.pov, "mesh{"
-    for s in self.povgroups[1]:
-      print >>self.pov, s
-    print >>self.pov, "pigment{color rgb<1,1,1>}"
-    print >>self.pov, "}"
-    self.pov.close()
+    if self.pov:
+      with instrument.Span("pov write"):
+        self.povgroups[0].Write(self.pov, "<0,0,0>")
+        self.povgroups[1].Write(self.pov, "<1,1,1>")
+        self.pov.close()
 
   def AddFacet(self, facet, group):
     if not facet.valid:
@@ -63,42 +282,438 @@ class STL:
       self.facedata.append(struct.pack('3f', *coord))
     #print(facet.coords)
     self.facedata.append(struct.pack('H', facet.att_bc))
-    self.povgroups[group].append(facet.Print(self.pov))
+    self.povgroups[group].AddFacet(facet)
+    if len(self.facedata) > 65536:
+      self.Flush()
+
+  # AddFacet() for callers that have no STLFacet: the vertices are
+  # (x, y, z) tuples or Vector3s and nothing is allocated per facet
+  # beyond the packed record.
+  def AddRawFacet(self, v1, v2, v3, group, att_bc=0):
+    nx, ny, nz, valid = FacetNormal(v1, v2, v3)
+    if not valid:
+      return
+    self.nfaces = self.nfaces + 1
+    self.facedata.append(struct.pack('12fH', nx, ny, nz, v1[0], v1[1], v1[2],
+                                     v2[0], v2[1], v2[2], v3[0], v3[1], v3[2],
+                                     att_bc))
+    self.povgroups[group].AddRawFacet(v1, v2, v3)
     if len(self.facedata) > 65536:
       self.Flush()
 
+  # AddFacet() for arrays of valid facets, e.g. from FacetNormals().
+  # group is an (N,) array giving the POV group of each facet.
+  def AddFacets(self, normals, v1, v2, v3, group):
+    with instrument.Span("pack facets", facets=len(group)):
+      records = FacetRecords(normals, v1, v2, v3)
+    self.WriteRecords(records)
+    self.AddPOVTriangles(v1, v2, v3, group)
+
+  # The POV half of AddFacets(), for facets whose STL records were
+  # written with WriteRecords()
+  def AddPOVTriangles(self, v1, v2, v3, group):
+    with instrument.Span("pov triangles", facets=len(group)):
+      self.AddFormattedPOV(self.FormatPOV(v1, v2, v3, group))
+
+  # The POV text of facets, one entry per group, split out of
+  # AddPOVTriangles() so worker processes can do the formatting
+  def FormatPOV(self, v1, v2, v3, group):
+    formatted = []
+    for g in range(len(self.povgroups)):
+      mask = Numeric.equal(group, g)
+      formatted.append(self.povgroups[g].Format(Numeric.compress(mask, v1, 0),
+                                                Numeric.compress(mask, v2, 0),
+                                                Numeric.compress(mask, v3, 0)))
+    return formatted
+
+  def AddFormattedPOV(self, formatted):
+    for g in range(len(self.povgroups)):
+      self.povgroups[g].AddFormatted(formatted[g])
+
+  # Write a string of packed 50 byte facet records, e.g. from
+  # FacetRecords(), straight to the file.
+  def WriteRecords(self, records):
+    with instrument.Span("write facets", facets=len(records) / 50):
+      self.Flush()
+      self.f.write(records)
+    self.nfaces = self.nfaces + len(records) / 50
+
   def Flush(self):
     self.f.write(''.join(self.facedata))
     self.facedata = []
 
   # Draws a cylinder connected to a triangle equilateral of side = trsize
-  def AddCylinder(self, bottom, top, radius, prec, trsize):
-    trradius = trsize / sqrt(3)
-    trpoints = []
-    for i in range(0,3):
-      trpoints.append(bottom + trsize * Vector3(cos((2*i+1)*pi/3), sin((2*i+1)*pi/3), 0))
-
-    prec3 = int(prec / 3)
-    p = []
-    for i in range(0, prec):
-      dangle = 2 * math.pi / prec
-      a0 = i * dangle
-      a1 = a0 + dangle
-      r0 = radius * Vector3(cos(a0), sin(a0), 0)
-      r1 = radius * Vector3(cos(a1), sin(a1), 0)
-      # self.AddFacet(STLFacet(bottom, bottom + r1, bottom + r0))
-      self.AddFacet(STLFacet(bottom + r0, bottom + r1, top + r1))
-      self.AddFacet(STLFacet(top + r1, top + r0, bottom + r0))
-      self.AddFacet(STLFacet(top, top + r0, top + r1))
-
-      #self.AddFacet(STLFacet(bottom + r0, trpoints[int(i / prec3)], bottom + r1))
-      if i % prec3 == 0:
-        p = p + [ r0 ]
-    #self.AddFacet(STLFacet(trpoints[0], trpoints[1], p[1]))
-    #self.AddFacet(STLFacet(trpoints[1], trpoints[2], p[2]))
-    #self.AddFacet(STLFacet(trpoints[2], trpoints[0], p[0]))
-    self.AddFacet(STLFacet(trpoints[0], trpoints[1], trpoints[2]))
+  def AddCylinder(self, bottom, top, radius, prec, trsize, group=0):
+    self.AddCylinders(Numeric.array([list(bottom)], Numeric.Float),
+                      Numeric.array([list(top)], Numeric.Float),
+                      radius, prec, trsize, group)
+
+  # AddCylinder() for arrays of cylinders sharing radius, prec and trsize:
+  # bottoms and tops are (M, 3) arrays.  The cylinder is tessellated once
+  # and placed at every (bottom, top) pair.
+  def AddCylinders(self, bottoms, tops, radius, prec, trsize, group=0):
+    cylinder = GetPrototype(("cylinder", prec, None), lambda: CylinderPrototype(prec))
+    v1, v2, v3, groups = cylinder.Instantiate([bottoms, tops], [radius, trsize])
+    normals, valid = FacetNormals(v1, v2, v3)
+    v1, v2, v3, normals = [Numeric.compress(valid, v, 0) for v in (v1, v2, v3, normals)]
+    self.AddFacets(normals, v1, v2, v3, Numeric.zeros(len(normals), Numeric.Int) + group)
+
+
+
+# STL writer for boards too big to hold in memory.
+#
+# Facets go through a write buffer of a fixed size straight to the STL
+# file, and the POV triangles to named spill files next to the .pov
+# (povname.group0/1), so memory stays bounded by memory_budget whatever
+# the board size.  Nothing is fsync'ed.
+#
+# Checkpoint(token) records how far the files are complete in
+# fname.resume.  Created with resume=True after an interrupted run, the
+# writer truncates its files back to the last checkpoint and exposes
+# that checkpoint's token as resume_token so the caller can carry on
+# from there.  key names what is being written (e.g. a hash of the
+# inputs); a checkpoint left by a run with another key, or whose files
+# are missing or shorter than it records, is deleted and the files are
+# started over.  The POV include always uses triangle{} lists; mesh2
+# would need a vertex index as big as the board.
+class StreamingSTL(STL):
+  def __init__(self, fname, povname, header, memory_budget=64 << 20,
+               resume=False, key=None):
+    self.memory_budget = memory_budget
+    self.key = key
+    buffer_bytes = max(1 << 20, memory_budget / 8)
+    self.checkpointname = fname + ".resume"
+    self.groupnames = ["%s.group%d" % (povname, g) for g in range(2)]
+    self.facedata = []
+    self.resume_token = None
+    state = None
+    if resume and os.path.exists(self.checkpointname):
+      state = json.load(open(self.checkpointname))
+      if state.get("key") != key or not self.Intact(fname, state):
+        os.remove(self.checkpointname)
+        state = None
+
+    if state:
+      self.f = open(fname, "r+b", buffer_bytes)
+      self.f.truncate(state["stl"])
+      self.f.seek(state["stl"])
+      groups = []
+      for name, size in zip(self.groupnames, state["groups"]):
+        f = open(name, "r+b", buffer_bytes)
+        f.truncate(size)
+        f.seek(size)
+        groups.append(f)
+      self.nfaces = state["nfaces"]
+      self.resume_token = state["token"]
+    else:
+      self.f = open(fname, "wb", buffer_bytes)
+      self.f.write('%-80.80s' % header)
+      self.f.write(struct.pack('<I', 0))
+      groups = [open(name, "w+b", buffer_bytes) for name in self.groupnames]
+      self.nfaces = 0
+    self.pov = open(povname, "w")
+    self.povgroups = [POVTriangleGroup(f) for f in groups]
+
+  # Whether the files still hold everything the checkpoint state covers
+  def Intact(self, fname, state):
+    sizes = [(fname, state["stl"])] + zip(self.groupnames, state["groups"])
+    for name, size in sizes:
+      if not os.path.exists(name) or os.path.getsize(name) < size:
+        return False
+    return True
+
+  def Checkpoint(self, token):
+    with instrument.Span("checkpoint"):
+      self.Flush()
+      self.f.flush()
+      for group in self.povgroups:
+        group.f.flush()
+    state = {"key": self.key,
+             "nfaces": self.nfaces,
+             "stl": self.f.tell(),
+             "groups": [group.f.tell() for group in self.povgroups],
+             "token": token}
+    tmpname = self.checkpointname + ".tmp"
+    f = open(tmpname, "w")
+    json.dump(state, f)
+    f.close()
+    os.rename(tmpname, self.checkpointname)
+
+  def Close(self):
+    STL.Close(self)
+    for name in self.groupnames + [self.checkpointname]:
+      if os.path.exists(name):
+        os.remove(name)
+
+
+# A POV include on its own, without the STL.  Facets go to the same two
+# groups STL writes, and shapes used many times can be #declare'd once
+# and placed with object{} statements.  Close() writes the declarations,
+# then per group its triangles and a union{} of its objects, both in the
+# group's color.
+class POVInclude:
+  # mesh2 - write the triangles as mesh2{} blocks, as STL does
+  def __init__(self, povname, mesh2=False):
+    self.pov = open(povname, "w")
+    self.nfaces = 0
+    self.declarations = []
+    self.objects = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+    self.nobjects = [0, 0]
+    if mesh2:
+      self.povgroups = [POVMesh2Group(), POVMesh2Group()]
+    else:
+      self.povgroups = [POVTriangleGroup(), POVTriangleGroup()]
+
+  # #declare name = value, e.g. a mesh{} or a transform{}
+  def Declare(self, name, value):
+    self.declarations.append("#declare %s = %s" % (name, value))
+
+  # lines - object{} statements placing declared shapes
+  def AddObjects(self, lines, group):
+    if lines:
+      print >>self.objects[group], "\n".join(lines)
+      self.nobjects[group] = self.nobjects[group] + len(lines)
+
+  def AddRawFacet(self, v1, v2, v3, group, att_bc=0):
+    if FacetNormal(v1, v2, v3)[3]:
+      self.nfaces = self.nfaces + 1
+      self.povgroups[group].AddRawFacet(v1, v2, v3)
+
+  def AddFacets(self, normals, v1, v2, v3, group):
+    with instrument.Span("pov triangles", facets=len(group)):
+      for g in range(len(self.povgroups)):
+        mask = Numeric.equal(group, g)
+        self.povgroups[g].AddTriangles(Numeric.compress(mask, v1, 0),
+                                       Numeric.compress(mask, v2, 0),
+                                       Numeric.compress(mask, v3, 0))
+    self.nfaces = self.nfaces + len(group)
+
+  def Close(self):
+    with instrument.Span("pov write"):
+      for declaration in self.declarations:
+        print >>self.pov, declaration
+      for g, color in enumerate(("<0,0,0>", "<1,1,1>")):
+        self.povgroups[g].Write(self.pov, color)
+        if self.nobjects[g]:
+          print >>self.pov, "union{"
+          self.objects[g].seek(0)
+          shutil.copyfileobj(self.objects[g], self.pov)
+          print >>self.pov, "pigment{color rgb%s}" % color
+          print >>self.pov, "}"
+        self.objects[g].close()
+      self.pov.close()
+
+
+# Facets stored as shared vertices plus an Int32 face index array.
+# Vertices closer than `quantum` (in mm) are welded into one.  It takes
+# facets like STL does (AddFacet/AddFacets), so MeshGenerator can render
+# into it, and writes STL, POV mesh2, OBJ or PLY files.
+#
+# Welding works on arrays: each vertex is quantized to one integer key
+# and looked up in the sorted keys seen so far, so the index costs two
+# numbers per distinct vertex.  Keys count from the minimum corner of
+# the vertices seen so far; when a vertex falls below it the corner
+# moves and the known keys are rebuilt.
+class IndexedMesh:
+  # Bits of the x, y and z keys: a span of 4.19 m, 4.19 m and 0.52 m
+  # from the minimum corner for a quantum of 1 um
+  KEY_BITS = (22, 22, 19)
+
+  def __init__(self, quantum=0.001):
+    self.quantum = quantum
+    self.origin = None
+    self.keys = Numeric.zeros(0, Numeric.Int)
+    self.ids = Numeric.zeros(0, Numeric.Int)
+    self.nvertices = 0
+    self.vertexchunks = []
+    self.facechunks = []
+    self.groupchunks = []
+    self.vertices = None
+    self.faces = None
+    self.groups = None
+
+  def Quantize(self, v):
+    return Numeric.floor(v / self.quantum + 0.5).astype(Numeric.Int)
+
+  # One integer per row of v, equal for vertices that weld
+  def Key(self, v):
+    q = self.Quantize(v) - self.origin
+    by, bz = self.KEY_BITS[1:]
+    for c, bits in enumerate(self.KEY_BITS):
+      if len(q) and Numeric.sometrue(Numeric.greater_equal(q[:, c], 1 << bits)):
+        raise ValueError("vertex out of range for a weld quantum of %g" % self.quantum)
+    return (q[:, 0] << (by + bz)) + (q[:, 1] << bz) + q[:, 2]
+
+  # Move the minimum corner down to take in v, rebuilding the keys of
+  # the vertices already welded
+  def Extend(self, v):
+    if not len(v):
+      return
+    low = Numeric.minimum.reduce(self.Quantize(v))
+    if self.origin is None:
+      self.origin = low
+    elif Numeric.sometrue(Numeric.less(low, self.origin)):
+      self.origin = Numeric.minimum(self.origin, low)
+      keys = self.Key(Numeric.concatenate(self.vertexchunks))
+      # Vertex ids are their positions in vertexchunks
+      self.ids = Numeric.argsort(keys)
+      self.keys = Numeric.take(keys, self.ids)
+
+  # Index of every row of v, adding the vertices not seen before.  New
+  # vertices are numbered in the order they first appear.
+  def Weld(self, v):
+    n = len(v)
+    self.Extend(v)
+    key = self.Key(v)
+    # Distinct keys of v (run) and the first row having each (first)
+    order = Numeric.argsort(key)
+    sorted_key = Numeric.take(key, order)
+    start = Numeric.ones(n, Numeric.Int)
+    start[1:] = Numeric.not_equal(sorted_key[1:], sorted_key[:-1])
+    run = Numeric.add.accumulate(start) - 1
+    row_run = Numeric.zeros(n, Numeric.Int)
+    Numeric.put(row_run, order, run)
+    nruns = n and run[-1] + 1
+    first = Numeric.zeros(nruns, Numeric.Int)
+    # Later puts win, so going backwards leaves the first row
+    Numeric.put(first, row_run[::-1], Numeric.arange(n)[::-1])
+    unique = Numeric.compress(start, sorted_key)
+
+    # Look the distinct keys up among the known ones
+    known = Numeric.zeros(nruns, Numeric.Int)
+    ids = Numeric.zeros(nruns, Numeric.Int) - 1
+    if len(self.keys):
+      pos = Numeric.minimum(Numeric.searchsorted(self.keys, unique), len(self.keys) - 1)
+      known = Numeric.equal(Numeric.take(self.keys, pos), unique)
+      ids = Numeric.where(known, Numeric.take(self.ids, pos), -1)
+
+    new = Numeric.nonzero(Numeric.logical_not(known))
+    if len(new):
+      new = Numeric.take(new, Numeric.argsort(Numeric.take(first, new)))
+      new_ids = Numeric.arange(self.nvertices, self.nvertices + len(new))
+      Numeric.put(ids, new, new_ids)
+      self.nvertices = self.nvertices + len(new)
+      self.vertexchunks.append(Numeric.take(v, Numeric.take(first, new), 0))
+      keys = Numeric.concatenate((self.keys, Numeric.take(unique, new)))
+      merged = Numeric.argsort(keys)
+      self.keys = Numeric.take(keys, merged)
+      self.ids = Numeric.take(Numeric.concatenate((self.ids, new_ids)), merged)
+    return Numeric.take(ids, row_run).astype(Numeric.Int32)
+
+  def AddFacet(self, facet, group):
+    if not facet.valid:
+      return
+    v = Numeric.array([list(facet.coords[k]) for k in range(1, 4)], Numeric.Float)
+    self.AddTriangles(v[0:1], v[1:2], v[2:3], Numeric.array([group]))
+
+  def AddRawFacet(self, v1, v2, v3, group):
+    if not FacetNormal(v1, v2, v3)[3]:
+      return
+    v = Numeric.array([tuple(v1), tuple(v2), tuple(v3)], Numeric.Float)
+    self.AddTriangles(v[0:1], v[1:2], v[2:3], Numeric.array([group]))
+
+  def AddFacets(self, normals, v1, v2, v3, group):
+    self.AddTriangles(v1, v2, v3, group)
+
+  def AddTriangles(self, v1, v2, v3, group):
+    faces = Numeric.zeros((len(v1), 3), Numeric.Int32)
+    faces[:, 0] = self.Weld(v1)
+    faces[:, 1] = self.Weld(v2)
+    faces[:, 2] = self.Weld(v3)
+    # Welding can collapse a sliver into a line
+    keep = Numeric.logical_and(Numeric.not_equal(faces[:, 0], faces[:, 1]),
+                               Numeric.not_equal(faces[:, 1], faces[:, 2]))
+    keep = Numeric.logical_and(keep, Numeric.not_equal(faces[:, 0], faces[:, 2]))
+    self.facechunks.append(Numeric.compress(keep, faces, 0))
+    self.groupchunks.append(Numeric.compress(keep, group).astype(Numeric.UnsignedInt8))
+    self.faces = None
+
+  # Join the added chunks into single arrays
+  def Pack(self):
+    if self.faces is not None:
+      return
+    if self.vertexchunks:
+      self.vertexchunks = [Numeric.concatenate(self.vertexchunks)]
+    if self.facechunks:
+      self.facechunks = [Numeric.concatenate(self.facechunks)]
+      self.groupchunks = [Numeric.concatenate(self.groupchunks)]
+    self.vertices = (self.vertexchunks or [Numeric.zeros((0, 3), Numeric.Float)])[0]
+    self.faces = (self.facechunks or [Numeric.zeros((0, 3), Numeric.Int32)])[0]
+    self.groups = (self.groupchunks or [Numeric.zeros(0, Numeric.UnsignedInt8)])[0]
+
+  def Corners(self, faces):
+    return [Numeric.take(self.vertices, faces[:, k], 0) for k in range(3)]
+
+  def WriteSTL(self, fname, header):
+    self.Pack()
+    v1, v2, v3 = self.Corners(self.faces)
+    normals, valid = FacetNormals(v1, v2, v3)
+    f = open(fname, "wb")
+    f.write('%-80.80s' % header)
+    f.write(struct.pack('<I', len(self.faces)))
+    f.write(FacetRecords(normals, v1, v2, v3))
+    f.close()
+
+  # The two POV groups as mesh2{} blocks, colored like STL.Close()
+  def WritePOV(self, povname):
+    self.Pack()
+    pov = open(povname, "w")
+    for group, color in ((0, "<0,0,0>"), (1, "<1,1,1>")):
+      self.WritePOVGroup(pov, group, color)
+    pov.close()
+
+  def WritePOVGroup(self, pov, group, color):
+    faces = Numeric.compress(Numeric.equal(self.groups, group), self.faces, 0)
+    if not len(faces):
+      return
+    # Renumber so the block only lists the vertices it uses
+    used = Numeric.zeros(self.nvertices, Numeric.Int32)
+    Numeric.put(used, Numeric.ravel(faces), 1)
+    ids = Numeric.nonzero(used)
+    renumber = Numeric.zeros(self.nvertices, Numeric.Int32)
+    Numeric.put(renumber, ids, Numeric.arange(len(ids)).astype(Numeric.Int32))
+    faces = Numeric.reshape(Numeric.take(renumber, Numeric.ravel(faces)), faces.shape)
+    print >>pov, "mesh2{"
+    print >>pov, "vertex_vectors{%d," % len(ids)
+    print >>pov, ",\n".join(PrintVectors(Numeric.take(self.vertices, ids, 0)))
+    print >>pov, "}"
+    print >>pov, "face_indices{%d," % len(faces)
+    print >>pov, ",\n".join(["<%d,%d,%d>" % tuple(f) for f in faces.tolist()])
+    print >>pov, "}"
+    print >>pov, "pigment{color rgb%s}" % color
+    print >>pov, "}"
+
+  def WriteOBJ(self, fname):
+    self.Pack()
+    f = open(fname, "w")
+    for v in self.vertices.tolist():
+      print >>f, "v %.4f %.4f %.4f" % tuple(v)
+    # OBJ counts vertices from 1
+    for face in (self.faces + 1).tolist():
+      print >>f, "f %d %d %d" % tuple(face)
+    f.close()
 
+  # Binary PLY in the byte order of this machine
+  def WritePLY(self, fname):
+    self.Pack()
+    nfaces = len(self.faces)
+    f = open(fname, "wb")
+    f.write("ply\n"
+            "format binary_%s_endian 1.0\n"
+            "element vertex %d\n"
+            "property float x\n"
+            "property float y\n"
+            "property float z\n"
+            "element face %d\n"
+            "property list uchar int vertex_indices\n"
+            "end_header\n" % (sys.byteorder, self.nvertices, nfaces))
+    f.write(self.vertices.astype(Numeric.Float32).tostring())
+    # Each face is a count byte (always 3) followed by three ints
+    faces = Numeric.reshape(Numeric.fromstring(self.faces.astype(Numeric.Int32).tostring(),
+                                               Numeric.UnsignedInt8), (nfaces, 12))
+    count = Numeric.zeros((nfaces, 1), Numeric.UnsignedInt8) + 3
+    f.write(Numeric.concatenate((count.astype(Numeric.UnsignedInt8), faces), 1).tostring())
+    f.close()
 
 
 def test():
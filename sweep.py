@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+sweep.py - Run nailcast2 over a grid of parameters
+
+Usage: python sweep.py image.png triangle_side_mm=4,6,8 canvas_width_mm=200,280
+
+Every combination of the listed values is built; parameters not listed
+keep their nailcast2.py value.  The image is decoded once and the
+halftones are sampled once per distinct lattice, so configurations that
+only differ in thickness_mm or margin_mm share them.  The meshes are
+rendered in a pool of worker processes to /tmp/sweep_<n>.stl and a
+summary table of nail and facet counts and timings goes to /tmp/sweep.txt.
+
+"""
+
+import sys
+import time
+import multiprocessing
+import nailcast2
+from halftone import image_array, sample_rgb, rgb_to_halftone, HalftoneLUT
+from stl import STL
+
+# The parameters a sweep can vary
+PARAMETERS = ("canvas_width_mm", "triangle_side_mm", "thickness_mm", "margin_mm")
+
+sweep_prefix = "/tmp/sweep" # meshes go to <prefix>_<n>.stl
+summary_txt = "/tmp/sweep.txt"
+sweep_processes = None # worker processes, None for one per core, 1 for no pool
+
+# Parse name=v1,v2,... arguments into the list of configurations, one
+# dict of PARAMETERS each.
+def Configurations(args):
+    values = dict([(name, [getattr(nailcast2, name)]) for name in PARAMETERS])
+    for arg in args:
+        name, sep, vals = arg.partition("=")
+        if name not in PARAMETERS or not vals:
+            raise ValueError("expected one of %s=v1,v2,... instead of %r" %
+                             ("/".join(PARAMETERS), arg))
+        values[name] = [float(v) for v in vals.split(",")]
+    configs = [{}]
+    for name in PARAMETERS:
+        configs = [dict(config.items() + [(name, v)])
+                   for config in configs for v in values[name]]
+    return configs
+
+# Set nailcast2's globals to a configuration
+def Apply(config):
+    for name in PARAMETERS:
+        setattr(nailcast2, name, config[name])
+
+def LatticeKey(config):
+    return config["canvas_width_mm"], config["triangle_side_mm"]
+
+# Sample the halftones of every distinct lattice among the configurations.
+# Returns {LatticeKey: ([(centers, halftones) per offset], seconds)}
+def SampleLattices(im, configs, lut=None):
+    pixels = image_array(im)
+    samples = {}
+    for config in configs:
+        key = LatticeKey(config)
+        if key in samples:
+            continue
+        start = time.time()
+        Apply(config)
+        lattices = []
+        for offset in nailcast2.LatticeOffsets(config["triangle_side_mm"]):
+            centers = nailcast2.artwork_centers(im, offset)
+            rgb = sample_rgb(centers, pixels, im.size[0], config["canvas_width_mm"])
+            if lut is not None:
+                halftones = lut.Halftones(rgb)
+            else:
+                halftones = rgb_to_halftone(rgb)
+            lattices.append((centers, halftones))
+        samples[key] = (lattices, time.time() - start)
+    return samples
+
+# The sampled lattices, set before the pool forks so the workers share them
+shared_samples = None
+
+# Build and render configuration n.  Returns its row of the summary.
+def RunConfiguration(job):
+    n, config = job
+    Apply(config)
+    lattices, sample_time = shared_samples[LatticeKey(config)]
+    start = time.time()
+    mesh = nailcast2.MeshGenerator(config["triangle_side_mm"], config["margin_mm"])
+    for centers, halftones in lattices:
+        nailcast2.InvPyramids(centers, halftones, mesh)
+    fname = "%s_%d.stl" % (sweep_prefix, n)
+    stl = STL(fname, None, "Sweep %d" % n)
+    mesh.RenderBatched(stl)
+    stl.Close()
+    return config, len(mesh.nails), stl.nfaces, sample_time, time.time() - start, fname
+
+def WriteSummary(rows, fname):
+    f = open(fname, "w")
+    print >>f, "%8s %8s %9s %7s %8s %9s %8s %8s  %s" % (
+        "canvas", "triangle", "thickness", "margin", "nails", "facets",
+        "sample_s", "render_s", "stl")
+    for config, nails, facets, sample_time, render_time, stlname in rows:
+        print >>f, "%8.1f %8.2f %9.2f %7.1f %8d %9d %8.3f %8.3f  %s" % (
+            config["canvas_width_mm"], config["triangle_side_mm"],
+            config["thickness_mm"], config["margin_mm"], nails, facets,
+            sample_time, render_time, stlname)
+    f.close()
+
+def main(argv=None):
+    global shared_samples
+    if argv is None:
+        argv = sys.argv
+    if len(argv) < 2:
+        print __doc__
+        return
+    configs = Configurations(argv[2:])
+    im = nailcast2.LoadImage(argv[1])[0]
+    lut = None
+    if nailcast2.lut_bits:
+        lut = HalftoneLUT(nailcast2.lut_bits)
+    shared_samples = SampleLattices(im, configs, lut)
+    print "%d configurations, %d lattices" % (len(configs), len(shared_samples))
+
+    jobs = list(enumerate(configs))
+    if len(jobs) == 1 or sweep_processes == 1:
+        rows = map(RunConfiguration, jobs)
+    else:
+        pool = multiprocessing.Pool(sweep_processes)
+        rows = pool.map(RunConfiguration, jobs)
+        pool.close()
+        pool.join()
+    shared_samples = None
+
+    WriteSummary(rows, summary_txt)
+    print open(summary_txt).read()
+
+if __name__ == '__main__': main()